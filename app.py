@@ -3,11 +3,15 @@ import requests
 import xml.etree.ElementTree as ET
 import html
 import time
-from datetime import datetime, timedelta
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 
 # Backend: Flask Application
 from flask import Flask, render_template, request, redirect, url_for, flash
+from markupsafe import Markup
 import sqlite3
+import click
 from pycoingecko import CoinGeckoAPI
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -62,6 +66,8 @@ news_cache = {
     'items': [],
     'last_updated': 0
 }
+# Items and last_updated are read and written together so the pair always matches
+news_cache_lock = threading.Lock()
 
 # --- Global Market Explorer Cache ---
 market_explorer_cache = {
@@ -69,11 +75,85 @@ market_explorer_cache = {
     'last_updated': 0
 }
 
+# --- Global Quote Cache ---
+# (currency, coingecko_id) -> coins/markets entry, refreshed at most once a minute
+quote_cache = {
+    'data': {},
+    'last_updated': {}
+}
+QUOTE_TTL = 60
+
+# --- Rendered Fragment Cache ---
+# Pre-rendered dashboard panels keyed by content version, LRU-evicted under a byte budget
+FRAGMENT_CACHE_MAX_BYTES = int(os.environ.get('FRAGMENT_CACHE_MAX_BYTES', 4 * 1024 * 1024))
+fragment_cache = {
+    'items': OrderedDict(), # key: (Markup, size in UTF-8 bytes)
+    'bytes': 0
+}
+fragment_cache_lock = threading.Lock()
+
+def get_cached_fragment(key, render):
+    """Return the fragment stored under `key`, calling `render()` to build it on a miss."""
+    with fragment_cache_lock:
+        entry = fragment_cache['items'].get(key)
+        if entry is not None:
+            fragment_cache['items'].move_to_end(key)
+            return entry[0]
+
+    fragment = Markup(render())
+    # Currency symbols and news titles are multi-byte, so budget on encoded size
+    size = len(fragment.encode('utf-8'))
+    if size > FRAGMENT_CACHE_MAX_BYTES:
+        return fragment
+
+    with fragment_cache_lock:
+        if key not in fragment_cache['items']:
+            fragment_cache['items'][key] = (fragment, size)
+            fragment_cache['bytes'] += size
+        # Evict least recently used fragments until we fit the budget again
+        while fragment_cache['bytes'] > FRAGMENT_CACHE_MAX_BYTES:
+            _, (_, evicted_size) = fragment_cache['items'].popitem(last=False)
+            fragment_cache['bytes'] -= evicted_size
+    return fragment
+
+def get_market_quotes(api_ids, currency):
+    """Return {coingecko_id: market data} for `api_ids`, plus a version that changes whenever any quote is refreshed."""
+    now = time.time()
+    stale_ids = [i for i in api_ids if now - quote_cache['last_updated'].get((currency, i), 0) >= QUOTE_TTL]
+    if stale_ids:
+        try:
+            # Fetch detailed data including 7d sparkline in USER CURRENCY
+            data = cg.get_coins_markets(vs_currency=currency, ids=stale_ids, sparkline=True, price_change_percentage='24h')
+            for item in data:
+                quote_cache['data'][(currency, item['id'])] = item
+                quote_cache['last_updated'][(currency, item['id'])] = now
+        except Exception as e:
+            print(f"API Error: {e}")
+
+    quotes = {}
+    version = 0
+    for api_id in api_ids:
+        key = (currency, api_id)
+        if key in quote_cache['data']:
+            quotes[api_id] = quote_cache['data'][key]
+            version = max(version, quote_cache['last_updated'][key])
+    return quotes, version
+
+def get_cached_price(api_id, currency):
+    """Return the cached price for `api_id` if it is still fresh, else None (never fetches)."""
+    key = (currency, api_id)
+    if time.time() - quote_cache['last_updated'].get(key, 0) < QUOTE_TTL:
+        return quote_cache['data'][key].get('current_price')
+    return None
+
 def get_market_news():
+    """Return (items, last_updated) from one consistent snapshot of the news cache."""
     global news_cache
+    with news_cache_lock:
+        snapshot = (news_cache['items'], news_cache['last_updated'])
     # Cache for 10 minutes (600 seconds)
-    if time.time() - news_cache['last_updated'] < 600 and news_cache['items']:
-        return news_cache['items']
+    if time.time() - snapshot[1] < 600 and snapshot[0]:
+        return snapshot
     
     url = "https://cointelegraph.com/rss"
     headers = {'User-Agent': 'Mozilla/5.0'}
@@ -104,12 +184,261 @@ def get_market_news():
                     })
             
             if parsed_items:
-                news_cache['items'] = parsed_items
-                news_cache['last_updated'] = time.time()
-                return parsed_items
+                last_updated = time.time()
+                with news_cache_lock:
+                    news_cache['items'] = parsed_items
+                    news_cache['last_updated'] = last_updated
+                return parsed_items, last_updated
     except Exception as e:
         print(f"News fetch error: {e}")
-    return news_cache['items']
+    with news_cache_lock:
+        return news_cache['items'], news_cache['last_updated']
+
+# --- Trade Summary Helpers ---
+def utc_timestamp(dt=None):
+    # Same format SQLite uses for CURRENT_TIMESTAMP, so string comparison orders correctly
+    return (dt or datetime.now(timezone.utc)).strftime('%Y-%m-%d %H:%M:%S')
+
+def apply_to_trade_summary(conn, user_id, symbol, trade_type, quantity, price, date):
+    """Fold a single trade into the per-user, per-symbol rollup."""
+    bought, sold = (quantity, 0) if trade_type == 'BUY' else (0, quantity)
+    conn.execute('''
+        INSERT INTO trade_summary (user_id, symbol, bought_qty, sold_qty, buy_volume, sell_volume, trade_count, first_trade, last_trade)
+        VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?)
+        ON CONFLICT (user_id, symbol) DO UPDATE SET
+            bought_qty = bought_qty + excluded.bought_qty,
+            sold_qty = sold_qty + excluded.sold_qty,
+            buy_volume = buy_volume + excluded.buy_volume,
+            sell_volume = sell_volume + excluded.sell_volume,
+            trade_count = trade_count + 1,
+            first_trade = MIN(first_trade, excluded.first_trade),
+            last_trade = MAX(last_trade, excluded.last_trade)
+    ''', (user_id, symbol, bought, sold, bought * price, sold * price, date, date))
+
+def record_transaction(conn, user_id, symbol, trade_type, quantity, price):
+    """Log a trade and keep the user's trade summary current in the same transaction."""
+    date = utc_timestamp()
+    cursor = conn.execute('''
+        INSERT INTO transactions (user_id, symbol, type, quantity, price, date)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, symbol, trade_type, quantity, price, date))
+    apply_to_trade_summary(conn, user_id, symbol, trade_type, quantity, price, date)
+    return cursor.lastrowid
+
+def rebuild_trade_summary(conn, user_id=None):
+    """Recompute trade summaries from scratch (raw and archived rows), for one user or everyone."""
+    where = ' WHERE user_id = ?' if user_id is not None else ''
+    params = (user_id,) if user_id is not None else ()
+
+    conn.execute('DELETE FROM trade_summary' + where, params)
+    conn.execute('''
+        INSERT INTO trade_summary (user_id, symbol, bought_qty, sold_qty, buy_volume, sell_volume, trade_count, first_trade, last_trade)
+        SELECT user_id, symbol,
+               SUM(CASE WHEN type = 'BUY' THEN quantity ELSE 0 END),
+               SUM(CASE WHEN type = 'SELL' THEN quantity ELSE 0 END),
+               SUM(CASE WHEN type = 'BUY' THEN quantity * price ELSE 0 END),
+               SUM(CASE WHEN type = 'SELL' THEN quantity * price ELSE 0 END),
+               COUNT(*), MIN(date), MAX(date)
+        FROM transactions''' + where + '''
+        GROUP BY user_id, symbol
+    ''', params)
+
+    # Fold archived rows back in
+    archives = conn.execute('SELECT user_id, payload FROM transactions_archive' + where, params).fetchall()
+    for archive in archives:
+        for date, symbol, trade_type, quantity, price in json.loads(archive['payload']):
+            apply_to_trade_summary(conn, archive['user_id'], symbol, trade_type, quantity, price, date)
+
+def compact_transactions(conn, user_id, older_than_days):
+    """Move a user's raw transactions older than `older_than_days` into one compact archive row."""
+    cutoff = utc_timestamp(datetime.now(timezone.utc) - timedelta(days=older_than_days))
+    # Rows still waiting for a backfilled price stay raw until they are resolved
+    pending = 'id NOT IN (SELECT transaction_id FROM price_backfill)'
+    rows = conn.execute('''
+        SELECT date, symbol, type, quantity, price FROM transactions
+        WHERE user_id = ? AND date < ? AND ''' + pending + '''
+        ORDER BY date
+    ''', (user_id, cutoff)).fetchall()
+    if not rows:
+        return 0
+
+    payload = [[r['date'], r['symbol'], r['type'], r['quantity'], r['price']] for r in rows]
+    conn.execute('''
+        INSERT INTO transactions_archive (user_id, first_date, last_date, row_count, payload)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (user_id, rows[0]['date'], rows[-1]['date'], len(rows), json.dumps(payload, separators=(',', ':'))))
+    conn.execute('DELETE FROM transactions WHERE user_id = ? AND date < ? AND ' + pending, (user_id, cutoff))
+    # Summaries already include these rows, so they stay as they are
+    return len(rows)
+
+def get_trade_summary(conn, user_id):
+    """Read a user's activity summary from the rollup table only (O(symbols))."""
+    rows = conn.execute('SELECT * FROM trade_summary WHERE user_id = ? ORDER BY symbol', (user_id,)).fetchall()
+    symbols = []
+    totals = {
+        'trade_count': 0,
+        'buy_volume': 0,
+        'sell_volume': 0,
+        'first_trade': None,
+        'last_trade': None
+    }
+    for row in rows:
+        symbols.append({
+            'symbol': row['symbol'],
+            'bought_qty': row['bought_qty'],
+            'sold_qty': row['sold_qty'],
+            'buy_volume': row['buy_volume'],
+            'sell_volume': row['sell_volume'],
+            'trade_count': row['trade_count'],
+            'first_trade': row['first_trade'],
+            'last_trade': row['last_trade']
+        })
+        totals['trade_count'] += row['trade_count']
+        totals['buy_volume'] += row['buy_volume']
+        totals['sell_volume'] += row['sell_volume']
+        if totals['first_trade'] is None or row['first_trade'] < totals['first_trade']:
+            totals['first_trade'] = row['first_trade']
+        if totals['last_trade'] is None or row['last_trade'] > totals['last_trade']:
+            totals['last_trade'] = row['last_trade']
+    return {'symbols': symbols, 'totals': totals}
+
+# --- Price Backfill ---
+# Transactions recorded without a known price are queued in price_backfill and
+# resolved in batches by a background worker, off the request path.
+PRICE_BACKFILL_INTERVAL = int(os.environ.get('PRICE_BACKFILL_INTERVAL', 30))
+PRICE_BACKFILL_BATCH_SIZE = 50
+# Failed lookups are retried with exponential backoff, capped at this delay
+PRICE_BACKFILL_MAX_DELAY = 6 * 3600
+# Rows still unresolved this long after being queued are marked failed (kept for re-queueing)
+PRICE_BACKFILL_GIVE_UP_AFTER = 3 * 24 * 3600
+# market_chart/range is one request per coin, so cap it per pass to stay under the rate limit
+PRICE_BACKFILL_MAX_RANGE_CALLS = 5
+# Trades younger than this are priced with a single batched spot quote
+PRICE_BACKFILL_SPOT_WINDOW = 600
+
+def enqueue_price_backfill(conn, transaction_id, coin_id):
+    conn.execute('''
+        INSERT INTO price_backfill (transaction_id, coin_id, attempts, next_attempt_at)
+        VALUES (?, ?, 0, 0)
+    ''', (transaction_id, coin_id))
+
+def price_backfill_delay(attempts):
+    """Seconds to wait before retrying a row that has failed `attempts` times."""
+    return min(PRICE_BACKFILL_INTERVAL * 2 ** attempts, PRICE_BACKFILL_MAX_DELAY)
+
+def fetch_historical_price(coin_id, timestamps):
+    """Return {timestamp: usd_price} using the closest market_chart point to each trade."""
+    data = cg.get_coin_market_chart_range_by_id(id=coin_id, vs_currency='usd',
+                                                 from_timestamp=int(min(timestamps)) - 3600,
+                                                 to_timestamp=int(max(timestamps)) + 3600)
+    points = data.get('prices', [])
+    if not points:
+        return {}
+    return {ts: min(points, key=lambda p: abs(p[0] / 1000 - ts))[1] for ts in timestamps}
+
+def process_price_backfill(limit=PRICE_BACKFILL_BATCH_SIZE):
+    """Resolve one batch of due queued prices (limit=-1 for all due rows).
+    Returns (jobs processed, transactions updated)."""
+    conn = get_db_connection()
+    try:
+        now = time.time()
+        # Only rows whose backoff has expired, soonest first
+        jobs = conn.execute('''
+            SELECT b.id, b.transaction_id, b.coin_id, b.attempts, b.created_at, t.user_id, t.symbol, t.type, t.quantity, t.date
+            FROM price_backfill b JOIN transactions t ON t.id = b.transaction_id
+            WHERE b.failed_at IS NULL AND b.next_attempt_at <= ?
+            ORDER BY b.next_attempt_at, b.id LIMIT ?
+        ''', (now, limit)).fetchall()
+        if not jobs:
+            return 0, 0
+
+        trade_ts = {job['id']: datetime.strptime(job['date'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+                    for job in jobs}
+        recent = [job for job in jobs if now - trade_ts[job['id']] < PRICE_BACKFILL_SPOT_WINDOW]
+        older = [job for job in jobs if now - trade_ts[job['id']] >= PRICE_BACKFILL_SPOT_WINDOW]
+
+        prices = {} # backfill id -> price
+        deferred = set() # backfill ids not tried this pass (range call budget used up)
+        if recent:
+            try:
+                data = cg.get_price(ids=list({job['coin_id'] for job in recent}), vs_currencies='usd')
+                for job in recent:
+                    price = data.get(job['coin_id'], {}).get('usd')
+                    if price is not None:
+                        prices[job['id']] = price
+            except Exception as e:
+                print(f"Price backfill error: {e}")
+
+        jobs_by_coin = {}
+        for job in older:
+            jobs_by_coin.setdefault(job['coin_id'], []).append(job)
+        range_calls = 0
+        for coin_id, coin_jobs in jobs_by_coin.items():
+            if range_calls >= PRICE_BACKFILL_MAX_RANGE_CALLS:
+                deferred.update(job['id'] for job in coin_jobs)
+                continue
+            range_calls += 1
+            try:
+                points = fetch_historical_price(coin_id, [trade_ts[job['id']] for job in coin_jobs])
+                for job in coin_jobs:
+                    if trade_ts[job['id']] in points:
+                        prices[job['id']] = points[trade_ts[job['id']]]
+            except Exception as e:
+                print(f"Price backfill error ({coin_id}): {e}")
+                # Most likely rate limited or offline: leave the other coins for a later pass
+                range_calls = PRICE_BACKFILL_MAX_RANGE_CALLS
+
+        give_up_before = utc_timestamp(datetime.now(timezone.utc) - timedelta(seconds=PRICE_BACKFILL_GIVE_UP_AFTER))
+        processed = 0
+        resolved = 0
+        for job in jobs:
+            if job['id'] in deferred:
+                continue
+            processed += 1
+            price = prices.get(job['id'])
+            if price is None:
+                if job['created_at'] < give_up_before:
+                    # Keep the row so it can be re-queued with 'flask backfill-prices --retry-failed'
+                    if conn.execute('UPDATE price_backfill SET failed_at = ? WHERE id = ? AND failed_at IS NULL',
+                                    (utc_timestamp(), job['id'])).rowcount == 1:
+                        print(f"Price backfill gave up on transaction {job['transaction_id']} ({job['coin_id']}), price left at 0")
+                else:
+                    conn.execute('UPDATE price_backfill SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ?',
+                                 (now + price_backfill_delay(job['attempts']), job['id']))
+                continue
+            # Claiming the queue row first keeps concurrent workers from applying the same price twice
+            if conn.execute('DELETE FROM price_backfill WHERE id = ?', (job['id'],)).rowcount != 1:
+                continue
+            conn.execute('UPDATE transactions SET price = ? WHERE id = ?', (price, job['transaction_id']))
+            # The summary counted this trade at price 0, so only the volume needs correcting
+            volume_column = 'buy_volume' if job['type'] == 'BUY' else 'sell_volume'
+            conn.execute(f'UPDATE trade_summary SET {volume_column} = {volume_column} + ? WHERE user_id = ? AND symbol = ?',
+                         (job['quantity'] * price, job['user_id'], job['symbol']))
+            resolved += 1
+        conn.commit()
+        return processed, resolved
+    finally:
+        conn.close()
+
+price_backfill_started = False
+price_backfill_lock = threading.Lock()
+
+def start_price_backfill_worker():
+    """Start the background backfill thread once per serving process (not on import)."""
+    global price_backfill_started
+    with price_backfill_lock:
+        if price_backfill_started:
+            return
+        price_backfill_started = True
+    threading.Thread(target=price_backfill_worker, daemon=True).start()
+
+def price_backfill_worker():
+    while True:
+        time.sleep(PRICE_BACKFILL_INTERVAL)
+        try:
+            process_price_backfill()
+        except Exception as e:
+            print(f"Price backfill worker error: {e}")
 
 def init_db():
     conn = get_db_connection()
@@ -120,7 +449,8 @@ def init_db():
             name TEXT NOT NULL,
             phone TEXT UNIQUE NOT NULL,
             password_hash TEXT NOT NULL,
-            currency TEXT DEFAULT 'USD'
+            currency TEXT DEFAULT 'USD',
+            holdings_rev INTEGER DEFAULT 0
         )
     ''')
     # Create Portfolio Table with User ID
@@ -149,6 +479,11 @@ def init_db():
         print("Migrating DB: Adding currency to users")
         conn.execute("ALTER TABLE users ADD COLUMN currency TEXT DEFAULT 'USD'")
     
+    # Holdings revision, bumped on every portfolio write (used to key cached fragments)
+    if 'holdings_rev' not in user_cols:
+        print("Migrating DB: Adding holdings_rev to users")
+        conn.execute("ALTER TABLE users ADD COLUMN holdings_rev INTEGER DEFAULT 0")
+    
     # Create Transactions Table (History)
     conn.execute('''
         CREATE TABLE IF NOT EXISTS transactions (
@@ -163,6 +498,64 @@ def init_db():
         )
     ''')
 
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_transactions_user_date ON transactions (user_id, date)')
+
+    # Cold storage for compacted transactions (one JSON payload per archived batch)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS transactions_archive (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            first_date TIMESTAMP NOT NULL,
+            last_date TIMESTAMP NOT NULL,
+            row_count INTEGER NOT NULL,
+            payload TEXT NOT NULL, -- JSON list of [date, symbol, type, quantity, price]
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    # Create Trade Summary Table (incrementally maintained rollup of transactions)
+    summary_exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'trade_summary'").fetchone()
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS trade_summary (
+            user_id INTEGER NOT NULL,
+            symbol TEXT NOT NULL,
+            bought_qty REAL NOT NULL DEFAULT 0,
+            sold_qty REAL NOT NULL DEFAULT 0,
+            buy_volume REAL NOT NULL DEFAULT 0,
+            sell_volume REAL NOT NULL DEFAULT 0,
+            trade_count INTEGER NOT NULL DEFAULT 0,
+            first_trade TIMESTAMP,
+            last_trade TIMESTAMP,
+            PRIMARY KEY (user_id, symbol),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    if not summary_exists:
+        print("Migrating DB: Building trade_summary from transactions")
+        rebuild_trade_summary(conn)
+
+    # Create Price Backfill Queue (transactions waiting for a price lookup)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS price_backfill (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            transaction_id INTEGER UNIQUE NOT NULL,
+            coin_id TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0, -- epoch seconds, backoff after a failed lookup
+            failed_at TIMESTAMP, -- set when we gave up; row kept for re-queueing
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (transaction_id) REFERENCES transactions (id)
+        )
+    ''')
+
+    # Check if backoff columns exist in price_backfill
+    cursor = conn.execute("PRAGMA table_info(price_backfill)")
+    backfill_cols = [row[1] for row in cursor.fetchall()]
+    if 'next_attempt_at' not in backfill_cols:
+        print("Migrating DB: Adding next_attempt_at and failed_at to price_backfill")
+        conn.execute('ALTER TABLE price_backfill ADD COLUMN next_attempt_at REAL NOT NULL DEFAULT 0')
+        conn.execute('ALTER TABLE price_backfill ADD COLUMN failed_at TIMESTAMP')
+
     # Create Alerts Table
     conn.execute('''
         CREATE TABLE IF NOT EXISTS alerts (
@@ -241,6 +634,10 @@ def logout():
 # --- Globals ---
 # Fetch top coins for autocomplete (Cached on startup)
 SUPPORTED_COINS = []
+COIN_ID_MAP = {}
+COIN_SYMBOL_MAP = {}
+COIN_NAME_MAP = {}
+COIN_LIST_VERSION = 0
 try:
     # Fetch top 250 coins by market cap
     coins_list = cg.get_coins_markets(vs_currency='usd', order='market_cap_desc', per_page=250, page=1)
@@ -249,10 +646,20 @@ try:
     COIN_ID_MAP = {c['id']: c['id'] for c in SUPPORTED_COINS}
     COIN_SYMBOL_MAP = {c['symbol']: c['id'] for c in SUPPORTED_COINS}
     COIN_NAME_MAP = {c['name'].lower(): c['id'] for c in SUPPORTED_COINS}
+    COIN_LIST_VERSION = time.time()
     print(f"Loaded {len(SUPPORTED_COINS)} coins for autocomplete.")
 except Exception as e:
     print(f"Error loading coin list: {e}")
 
+# helper to resolve symbol -> id
+def resolve_coingecko_id(search_term):
+    search_term = search_term.lower().strip()
+    # Use pre-computed maps for O(1) lookup
+    return COIN_ID_MAP.get(search_term) or \
+           COIN_SYMBOL_MAP.get(search_term) or \
+           COIN_NAME_MAP.get(search_term) or \
+           search_term
+
 CURRENCY_SYMBOLS = {
     'usd': '$', 'eur': '€', 'gbp': '£', 'inr': '₹', 'jpy': '¥', 'aud': 'A$', 'cad': 'C$'
 }
@@ -270,21 +677,13 @@ def index():
 
     conn = get_db_connection()
     portfolio_items = conn.execute('SELECT * FROM portfolio WHERE user_id = ?', (current_user.id,)).fetchall()
+    holdings_rev = conn.execute('SELECT holdings_rev FROM users WHERE id = ?', (current_user.id,)).fetchone()['holdings_rev'] or 0
     conn.close()
 
     portfolio_data = []
     total_value = 0
     total_cost = 0
     
-    # helper to resolve symbol -> id
-    def resolve_coingecko_id(search_term):
-        search_term = search_term.lower().strip()
-        # Use pre-computed maps for O(1) lookup
-        return COIN_ID_MAP.get(search_term) or \
-               COIN_SYMBOL_MAP.get(search_term) or \
-               COIN_NAME_MAP.get(search_term) or \
-               search_term
-    
     # Resolve IDs for all items
     resolved_ids_map = {} # db_symbol -> api_id
     api_ids = []
@@ -298,15 +697,8 @@ def index():
             
         api_ids = list(set(api_ids))
 
-    market_data_map = {}
-    if api_ids:
-        try:
-            # Fetch detailed data including 7d sparkline in USER CURRENCY
-            data = cg.get_coins_markets(vs_currency=user_currency, ids=api_ids, sparkline=True, price_change_percentage='24h')
-            # Map by API ID
-            market_data_map = {item['id']: item for item in data}
-        except Exception as e:
-            print(f"API Error: {e}")
+    # Map by API ID (served from the quote cache while fresh)
+    market_data_map, quote_version = get_market_quotes(api_ids, user_currency)
 
     for item in portfolio_items:
         db_symbol = item['symbol']
@@ -373,19 +765,36 @@ def index():
     total_roi = (total_pl / total_cost * 100) if total_cost > 0 else 0
 
     # Fetch news
-    news = get_market_news()
+    news, news_version = get_market_news()
+
+    # Shared panels are rendered once per content version, per-user panels
+    # once per (holdings revision, quote version, currency)
+    news_html = get_cached_fragment(('news', news_version),
+                                    lambda: render_template('partials/_news.html', news=news))
+    coin_options_html = get_cached_fragment(('coin_options', COIN_LIST_VERSION),
+                                            lambda: render_template('partials/_coin_options.html', all_coins=SUPPORTED_COINS))
+
+    portfolio_version = (current_user.id, holdings_rev, quote_version, user_currency)
+    def render_portfolio_fragment(template):
+        return lambda: render_template(template, portfolio=portfolio_data, currency_symbol=currency_symbol)
+    ticker_html = get_cached_fragment(('ticker',) + portfolio_version, render_portfolio_fragment('partials/_ticker.html'))
+    market_cards_html = get_cached_fragment(('market_cards',) + portfolio_version, render_portfolio_fragment('partials/_market_cards.html'))
+    holdings_rows_html = get_cached_fragment(('holdings_rows',) + portfolio_version, render_portfolio_fragment('partials/_holdings_rows.html'))
+    portfolio_json = get_cached_fragment(('portfolio_json',) + portfolio_version, lambda: json.dumps(portfolio_data))
 
     return render_template('index.html', 
-                           portfolio=portfolio_data, 
+                           ticker_html=ticker_html,
+                           market_cards_html=market_cards_html,
+                           holdings_rows_html=holdings_rows_html,
+                           coin_options_html=coin_options_html,
+                           news_html=news_html,
                            total_value=total_value,
                            total_pl=total_pl,
                            total_roi=total_roi,
                            username=current_user.name,
-                           portfolio_json=json.dumps(portfolio_data),
-                           all_coins=SUPPORTED_COINS,
+                           portfolio_json=portfolio_json,
                            currency_symbol=currency_symbol,
-                           current_currency=user_currency.upper(),
-                           news=news)
+                           current_currency=user_currency.upper())
 
 @app.route('/set_currency', methods=['GET', 'POST'])
 @login_required
@@ -416,10 +825,7 @@ def add_coin():
     
     if trade_type == 'BUY':
         # 1. Log Transaction
-        cursor.execute('''
-            INSERT INTO transactions (user_id, symbol, type, quantity, price)
-            VALUES (?, ?, 'BUY', ?, ?)
-        ''', (current_user.id, symbol, quantity, trade_price))
+        record_transaction(conn, current_user.id, symbol, 'BUY', quantity, trade_price)
         
         if result:
             # Existing coin: Update weighted average
@@ -445,10 +851,7 @@ def add_coin():
             flash(f'Error: Insufficient {symbol.upper()} quantity to sell.', 'error')
         else:
             # 1. Log Transaction
-            cursor.execute('''
-                INSERT INTO transactions (user_id, symbol, type, quantity, price)
-                VALUES (?, ?, 'SELL', ?, ?)
-            ''', (current_user.id, symbol, quantity, trade_price))
+            record_transaction(conn, current_user.id, symbol, 'SELL', quantity, trade_price)
             
             new_quantity = result['quantity'] - quantity
             if new_quantity <= 0:
@@ -458,6 +861,9 @@ def add_coin():
                 # Keep same avg_buy_price (cost basis doesn't change on sell)
                 cursor.execute('UPDATE portfolio SET quantity = ? WHERE id = ?', (new_quantity, result['id']))
                 flash(f'Successfully sold {quantity} {symbol.upper()}', 'success')
+    
+    # Invalidate cached dashboard fragments for this user
+    cursor.execute('UPDATE users SET holdings_rev = holdings_rev + 1 WHERE id = ?', (current_user.id,))
                 
     conn.commit()
     conn.close()
@@ -471,27 +877,17 @@ def delete_coin(id):
     item = conn.execute('SELECT * FROM portfolio WHERE id = ? AND user_id = ?', (id, current_user.id)).fetchone()
     
     if item:
-        # Log as SELL (assuming selling at current market price roughly, OR just 0 if unknown, 
-        # but better to log the exit. Since we don't have price here easily without fetching,
-        # we will fetch price or just log the quantity and symbol.
-        # Fetching price makes it slow but accurate.
-        try:
-            # Quick fetch for accuracy
-            price_data = cg.get_price(ids=item['symbol'], vs_currencies='usd') # Default to USD for base recording
-            # Wait, our transactions table stores 'price'. 
-            # If we want to support multi-currency properly later, we should store currency in transactions.
-            # For now, we store in USD (or whatever base is). 
-            # Simplification: Store 0 or try fetch.
-            current_price = price_data.get(item['symbol'], {}).get('usd', 0)
-        except:
-            current_price = 0
+        # Log as SELL at the current USD price (base recording currency). Never hit the
+        # network here: use a fresh cached quote, otherwise let the backfill worker fill it in.
+        api_id = resolve_coingecko_id(item['symbol'])
+        current_price = get_cached_price(api_id, 'usd')
 
-        conn.execute('''
-            INSERT INTO transactions (user_id, symbol, type, quantity, price)
-            VALUES (?, ?, 'SELL', ?, ?)
-        ''', (current_user.id, item['symbol'], item['quantity'], current_price))
+        tx_id = record_transaction(conn, current_user.id, item['symbol'], 'SELL', item['quantity'], current_price or 0)
+        if current_price is None:
+            enqueue_price_backfill(conn, tx_id, api_id)
 
         conn.execute('DELETE FROM portfolio WHERE id = ? AND user_id = ?', (id, current_user.id))
+        conn.execute('UPDATE users SET holdings_rev = holdings_rev + 1 WHERE id = ?', (current_user.id,))
     
     conn.commit()
     conn.close()
@@ -505,12 +901,24 @@ def history():
     
     conn = get_db_connection()
     transactions = conn.execute('SELECT * FROM transactions WHERE user_id = ? ORDER BY date DESC', (current_user.id,)).fetchall()
+    summary = get_trade_summary(conn, current_user.id)
+    archived_count = conn.execute('SELECT COALESCE(SUM(row_count), 0) FROM transactions_archive WHERE user_id = ?', (current_user.id,)).fetchone()[0]
     conn.close()
     
     return render_template('history.html', 
                            transactions=transactions,
+                           summary=summary,
+                           archived_count=archived_count,
                            currency_symbol=currency_symbol)
 
+@app.route('/api/trade_summary')
+@login_required
+def trade_summary():
+    conn = get_db_connection()
+    summary = get_trade_summary(conn, current_user.id)
+    conn.close()
+    return json.dumps(summary)
+
 @app.route('/export/history')
 @login_required
 def export_history():
@@ -520,6 +928,7 @@ def export_history():
 
     conn = get_db_connection()
     transactions = conn.execute('SELECT * FROM transactions WHERE user_id = ? ORDER BY date DESC', (current_user.id,)).fetchall()
+    archives = conn.execute('SELECT payload FROM transactions_archive WHERE user_id = ? ORDER BY last_date DESC', (current_user.id,)).fetchall()
     conn.close()
 
     output = io.StringIO()
@@ -529,6 +938,11 @@ def export_history():
     for tx in transactions:
         writer.writerow([tx['date'], tx['symbol'].upper(), tx['type'], tx['quantity'], tx['price']])
 
+    # Archived rows are always older than the raw ones
+    for archive in archives:
+        for date, symbol, trade_type, quantity, price in reversed(json.loads(archive['payload'])):
+            writer.writerow([date, symbol.upper(), trade_type, quantity, price])
+
     output.seek(0)
     return Response(
         output.getvalue(),
@@ -647,7 +1061,57 @@ def market_explorer():
         print(f"Market Explorer API Error: {e}")
         return json.dumps([])
 
+# --- CLI Commands ---
+@app.cli.command('rebuild-summaries')
+@click.option('--user-id', type=int, default=None, help='Only rebuild this user (default: everyone).')
+def rebuild_summaries_command(user_id):
+    """Recompute trade_summary from transactions and the archive."""
+    conn = get_db_connection()
+    rebuild_trade_summary(conn, user_id)
+    conn.commit()
+    conn.close()
+    print("Trade summaries rebuilt.")
+
+@app.cli.command('compact-history')
+@click.option('--days', type=int, default=90, show_default=True, help='Archive raw transactions older than this.')
+@click.option('--user-id', type=int, default=None, help='Only compact this user (default: everyone).')
+def compact_history_command(days, user_id):
+    """Archive old raw transactions per user into transactions_archive."""
+    conn = get_db_connection()
+    if user_id is not None:
+        user_ids = [user_id]
+    else:
+        user_ids = [row['id'] for row in conn.execute('SELECT id FROM users').fetchall()]
+    total = 0
+    for uid in user_ids:
+        total += compact_transactions(conn, uid, days)
+        conn.commit()
+    conn.close()
+    print(f"Archived {total} transactions older than {days} days.")
+
+@app.cli.command('backfill-prices')
+@click.option('--retry-failed', is_flag=True, help='Re-queue rows the worker gave up on before running.')
+def backfill_prices_command(retry_failed):
+    """Run one pass over the queued transaction prices that are due now."""
+    conn = get_db_connection()
+    if retry_failed:
+        conn.execute('UPDATE price_backfill SET failed_at = NULL, attempts = 0, next_attempt_at = 0, created_at = CURRENT_TIMESTAMP WHERE failed_at IS NOT NULL')
+        conn.commit()
+    conn.close()
+
+    # A single pass: failed rows are pushed back by their backoff rather than retried in a tight loop
+    processed, resolved = process_price_backfill(limit=-1)
+
+    conn = get_db_connection()
+    waiting = conn.execute('SELECT COUNT(*) FROM price_backfill WHERE failed_at IS NULL').fetchone()[0]
+    failed = conn.execute('SELECT COUNT(*) FROM price_backfill WHERE failed_at IS NOT NULL').fetchone()[0]
+    conn.close()
+    print(f"Backfilled {resolved} of {processed} transaction prices ({waiting} still queued, {failed} failed).")
+
 if __name__ == '__main__':
     print("Starting Flask Server...")
     print("Open your browser and go to: http://127.0.0.1:5000")
+    # Only the reloader's child process actually serves requests
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_price_backfill_worker()
     app.run(debug=True)
@@ -0,0 +1,6 @@
+# Gunicorn picks this file up automatically (see Procfile)
+
+def post_fork(server, worker):
+    # Run the price backfill poller in the workers, never in the master or on plain imports
+    from app import start_price_backfill_worker
+    start_price_backfill_worker()